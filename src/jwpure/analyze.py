@@ -1,33 +1,77 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache, wraps
 from importlib import resources
-from numpy import issubdtype
+from numpy import (
+    arange, array, cumsum, issubdtype, maximum, ones, where
+)
 from sqlite3 import connect
 
 from astropy.io.ascii import read as ascii_read
 from astropy.table import Table
 
-from .query import DatabaseTable, where_clause
+from .query import DatabaseTable, render_sql, where_clause
 
 DEFAULT_SLOT_DATA_PATH = resources.files('jwpure.data') / 'pure_slots.csv'
 
+# The database lives in memory, so skip durability work. Keep the default
+# in-memory rollback journal, which ROLLBACK needs to undo a failed pass.
+PRAGMAS = [
+    'PRAGMA synchronous = OFF',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -262144',
+]
+
+
+def transaction(method):
+    '''Run a Scenario method inside a single database transaction.
+
+    Commits if the method returns. Rolls back if the method raises.
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.db:
+            self.cursor.execute('BEGIN')
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class Scenario:
     '''Assess a JWST pure parallel observing scenario.
 
-    Creates a database in memory. Loads slot data. Facilitates queries.'''
-    def __init__(self, slot_data_path=DEFAULT_SLOT_DATA_PATH):
+    Creates a database in memory. Loads slot data. Facilitates queries.
+
+    Args:
+        slot_data_path (str): path to file that contains slot data
+        slotdata (astropy.table.Table): optional, slot data returned by
+            `read_slot_data`. Skips reading `slot_data_path`, so many
+            scenarios can share slot data that was read once.
+    '''
+    def __init__(self, slot_data_path=DEFAULT_SLOT_DATA_PATH, slotdata=None):
         self.slot_data_path = slot_data_path
-        self.db = connect(':memory:')
+        self.db = connect(':memory:', isolation_level=None)
         self.cursor = self.db.cursor()
-        slotdata = ascii_read(slot_data_path)
-        slotdata['visit_id'] = [f'{v:011}' for v in slotdata['visit_id']]
+        for pragma in PRAGMAS:
+            self.cursor.execute(pragma)
+        if slotdata is None:
+            slotdata = read_slot_data(slot_data_path)
+        # Reset allocations in slot data from a previous scenario (e.g. save).
         colnames = ['pure_subset', 'pure_visit', 'pure_config', 'pure_slot']
-        for colname in colnames:
-            slotdata[colname] = 0
-        self.create_database_table('slot', slotdata)
+        existing = [c for c in colnames if c in slotdata.colnames]
+        if existing:
+            slotdata = slotdata.copy(copy_data=False)
+            slotdata.remove_columns(existing)
+        self.create_database_table('slot', slotdata, extra_coldefs=[
+            f'{colname} INTEGER DEFAULT 0' for colname in colnames
+        ])
+        for colname in ['slot_id', 'config_id', 'visit_id']:
+            self.cursor.execute(
+                f'CREATE INDEX slot_{colname} ON slot({colname})'
+            )
         self.where_joint = []
         self.pure_subset = 0
 
     @staticmethod
+    @cache
     def constraint_parameters():
         '''Return objects representing parameters used to express constraints.
 
@@ -44,7 +88,7 @@ class Scenario:
         visit = DatabaseTable('visit', 'nconfig')
         return slot, config, visit
 
-
+    @transaction
     def allocate_slots(
             self, constraint, maxslot=999, maxconfig=999, trace_id=None):
         '''Allocate pure parallel slots that obey the specifed constraints.
@@ -53,6 +97,8 @@ class Scenario:
             1. Apply constraints on slot table to create config table.
             2. Apply constraints on config table to create visit table.
             3. Apply constraints on visit table to create final list of slots.
+        Steps 1-3 run as one query. The intermediate tables are created in
+        the database only when tracing a visit.
 
         Args:
             constraint (expression): expression that constrains slots
@@ -60,70 +106,82 @@ class Scenario:
             maxconfig (int, default=999): max configs to keep in a visit
             trace_id (str, default=None): identifier for visit to trace
         '''
-        # Increment subset number.
-        self.pure_subset += 1
-        self._trace(trace_id, 'slot', f'Subset {self.pure_subset}, slot table')
+        # Number this subset. Record it only after the database is updated.
+        pure_subset = self.pure_subset + 1
+        self._trace(trace_id, 'slot', f'Subset {pure_subset}, slot table')
 
         # Identify "available" slots (not part of a previous subset).
         slot, config, visit = self.constraint_parameters()
         available = (slot.pure_subset == 0)
 
-        # Create new `config` table. Apply slot constraint to available slots.
-        where_slot = where_clause(constraint & available, only_table='slot')
-        self.cursor.execute('DROP TABLE IF EXISTS config')
-        self.cursor.execute(f'''
-            CREATE TABLE config AS
+        # Query for `config` table. Apply slot constraint to available slots.
+        where_slot, slot_params = where_clause(
+            constraint & available, only_table='slot'
+        )
+        config_query = f'''
             SELECT visit_id, config_id, COUNT(*) nslot, SUM(slotdur) configdur
             FROM slot
             {where_slot}
             GROUP BY visit_id, config_id
-        ''')
-        self._trace(
-           trace_id, 'config', f'Subset {self.pure_subset}, config table'
-        )
+        '''
 
-        # Make new `visit` table. Apply config constraint to selected slots.
-        where_config = where_clause(constraint, only_table='config')
-        self.cursor.execute('DROP TABLE IF EXISTS visit')
-        self.cursor.execute(f'''
-            CREATE TABLE visit AS
+        # Query for `visit` table. Apply config constraint to selected slots.
+        where_config, config_params = where_clause(
+            constraint, only_table='config'
+        )
+        visit_query = f'''
             SELECT visit_id, COUNT(*) nconfig
             FROM config
             {where_config}
             GROUP BY visit_id
-        ''')
-        self._trace(
-            trace_id, 'visit', f'Subset {self.pure_subset}, visit table'
-        )
+        '''
 
-        # Make new `subset` table. Jointly apply all constraints.
-        where_joint = where_clause(constraint)
-        self.where_joint.append(where_joint)
-        self.cursor.execute('DROP TABLE IF EXISTS subset')
-        self.cursor.execute(f'''
-            CREATE TABLE subset AS
+        # Query for `subset` table. Jointly apply all constraints.
+        where_joint, joint_params = where_clause(constraint)
+        where_text = render_sql(where_joint, joint_params)
+        subset_query = f'''
             SELECT visit.visit_id, config.config_id, slot.slot_id
             FROM slot
             JOIN config ON config.config_id = slot.config_id
             JOIN visit ON visit.visit_id = slot.visit_id
             {where_joint}
-        ''')
-        self._trace(
-            trace_id, 'subset', f'Subset {self.pure_subset}, subset table'
-        )
+        '''
+
+        # Materialize intermediate tables only when tracing a visit.
+        queries = {
+            'config': (config_query, slot_params),
+            'visit': (visit_query, config_params),
+            'subset': (subset_query, joint_params),
+        }
+        for tablename, (query, params) in queries.items():
+            self.cursor.execute(f'DROP TABLE IF EXISTS {tablename}')
+            if trace_id:
+                self.cursor.execute(
+                    f'CREATE TABLE {tablename} AS {query}', params
+                )
+                self._trace(
+                    trace_id, tablename,
+                    f'Subset {pure_subset}, {tablename} table'
+                )
 
         # Assign sequence numbers to visits, configs, and slots.
-        self.cursor.execute('''
+        self.cursor.execute(f'''
+            WITH
+                config AS ({config_query}),
+                visit AS ({visit_query}),
+                subset AS ({subset_query})
             SELECT visit_id, config_id, slot_id
             FROM subset
             ORDER BY slot_id
-        ''')
+        ''', slot_params + config_params + joint_params)
         rows = self.cursor.fetchall()
-        sequence_numbers = self._sequence_numbers(rows, maxslot, maxconfig)
+        sequence_numbers = self._sequence_numbers(
+            rows, pure_subset, maxslot, maxconfig
+        )
         self.cursor.execute('DROP TABLE IF EXISTS sequence_numbers')
         self.cursor.execute('''
             CREATE TABLE sequence_numbers (
-                visit_id TEXT, config_id TEXT, slot_id TEXT,
+                visit_id INTEGER, config_id TEXT, slot_id TEXT,
                 pure_subset INTEGER, pure_visit INTEGER,
                 pure_config INTEGER, pure_slot INTEGER)
         ''')
@@ -133,35 +191,36 @@ class Scenario:
                 pure_subset, pure_visit, pure_config, pure_slot)
             VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', sequence_numbers)
+        self.cursor.execute(
+            'CREATE INDEX sequence_numbers_slot_id '
+            'ON sequence_numbers(slot_id)'
+        )
         self._trace(
             trace_id, 'sequence_numbers',
-            f'Subset {self.pure_subset}, subset table'
+            f'Subset {pure_subset}, subset table'
         )
 
         # Update `slot.pure_subset` to indicate slots used in this subset.
-        self.cursor.execute(f'''
+        self.cursor.execute('''
             UPDATE slot
-            SET pure_subset = (
-                    SELECT pure_subset FROM sequence_numbers sn
-                    WHERE sn.slot_id = slot.slot_id
-                ),
-                pure_visit = (
-                    SELECT pure_visit FROM sequence_numbers sn
-                    WHERE sn.slot_id = slot.slot_id
-                ),
-                pure_config = (
-                    SELECT pure_config FROM sequence_numbers sn
-                    WHERE sn.slot_id = slot.slot_id
-                ),
-                pure_slot = (
-                    SELECT pure_slot FROM sequence_numbers sn
-                    WHERE sn.slot_id = slot.slot_id
-                )
-            WHERE slot_id IN (SELECT slot_id FROM subset)
+            SET pure_subset = sn.pure_subset,
+                pure_visit = sn.pure_visit,
+                pure_config = sn.pure_config,
+                pure_slot = sn.pure_slot
+            FROM sequence_numbers sn
+            WHERE sn.slot_id = slot.slot_id
+            AND (
+                slot.pure_subset != sn.pure_subset OR
+                slot.pure_visit != sn.pure_visit OR
+                slot.pure_config != sn.pure_config OR
+                slot.pure_slot != sn.pure_slot
+            )
         ''')
+        self.pure_subset = pure_subset
+        self.where_joint.append(where_text)
 
-    def summarize(self, path=None, table='slot'):
-        '''Summarize slot information in a table.'''
+    def summarize(self, path=None, table='slot', verbose=True):
+        '''Summarize slot information in a table. Print it, if verbose.'''
         query = (
             f'SELECT'
             f'  cycle, '
@@ -177,7 +236,7 @@ class Scenario:
         self.cursor.execute(query)
         rows = self.cursor.fetchall()
         colnames = [desc[0] for desc in self.cursor.description]
-        table = Table(rows=rows, names=colnames)
+        table = table_from_rows(rows, colnames)
         if path:
             with open(path, 'w') as fobj:
                 for line in table.pformat(max_width=None):
@@ -185,12 +244,17 @@ class Scenario:
                 for i, where_joint in enumerate(self.where_joint):
                     fobj.write(f'Subset {i+1}: {where_joint}\n')
             print(f'wrote {path}')
-        table.pprint()
+        if verbose:
+            table.pprint()
         return table
 
     def save(self, path):
         '''Save information about pure parallel slots to a file.'''
-        query = 'SELECT * FROM slot WHERE pure_subset > 0 ORDER BY slot_id'
+        columns = self._output_columns('slot')
+        query = (
+            f'SELECT {columns} FROM slot '
+            f'WHERE pure_subset > 0 ORDER BY slot_id'
+        )
         self.raw_query(query, path=path)
 
     def raw_query(self, query, path=None):
@@ -200,38 +264,63 @@ class Scenario:
         if not rows:
             return
         colnames = [desc[0] for desc in self.cursor.description]
-        table = Table(rows=rows, names=colnames)
+        table = table_from_rows(rows, colnames)
         if path:
             table.write(path, format='ascii.csv', overwrite=True)
             print(f'wrote {path}')
         return table
 
-    def create_database_table(self, tablename, table):
+    @transaction
+    def create_database_table(self, tablename, table, extra_coldefs=()):
         '''Create and load database table with contents of an astropy table.
 
         Args:
             tablename (str): Name of database table to create.
             table (astropy.table.Table): Column names, types, and values.
+            extra_coldefs (list of str): optional, definitions of additional
+                columns not in `table`, e.g. 'pure_slot INTEGER DEFAULT 0'.
         '''
         coldefs = []
         for colname, column in table.columns.items():
             coldefs.append(f'{colname} {sqltype(column.dtype)}')
+        coldefs.extend(extra_coldefs)
         create_statement = f"CREATE TABLE {tablename} ({', '.join(coldefs)});"
         self.cursor.execute(create_statement)
-        placeholders = ', '.join(['?'] * len(coldefs))
-        insert_statement = f"INSERT INTO {tablename} VALUES ({placeholders})"
-        self.cursor.executemany(insert_statement, table.as_array().tolist())
+        colnames = ', '.join(table.colnames)
+        placeholders = ', '.join(['?'] * len(table.colnames))
+        insert_statement = (
+            f"INSERT INTO {tablename} ({colnames}) VALUES ({placeholders})"
+        )
+        self.cursor.executemany(insert_statement, table_rows(table))
 
     def _trace(self, trace_id, table, title):
         '''Print rows in the specified table for the specified visit.'''
         if not trace_id:
             return
-        query = f'SELECT * FROM {table} WHERE visit_id = "{trace_id}"'
+        columns = self._output_columns(table)
+        query = (
+            f'SELECT {columns} FROM {table} '
+            f'WHERE visit_id = {int(trace_id)}'
+        )
         table = self.raw_query(query)
         print(f'\n{title}')
         print(table)
 
-    def _sequence_numbers(self, rows, maxslot=999, maxconfig=999):
+    def _output_columns(self, table):
+        '''Return select list for all columns, with visit_id zero padded.
+
+        Visit identifiers are stored as integers in the database, but are
+        written as 11-digit strings (e.g., 01176311001).
+        '''
+        self.cursor.execute(f'SELECT * FROM {table} LIMIT 0')
+        colnames = [desc[0] for desc in self.cursor.description]
+        return ', '.join([
+            f"printf('%011d', {colname}) AS {colname}"
+            if colname == 'visit_id' else colname
+            for colname in colnames
+        ])
+
+    def _sequence_numbers(self, rows, pure_subset, maxslot=999, maxconfig=999):
         '''Assign sequence numbers to visits, configs, and slots.
 
         Sequence numbers begin at 1 and increment.
@@ -240,37 +329,154 @@ class Scenario:
 
         Args:
             rows (list of tuple): visit_id, config_id, and slot_id for slot
+            pure_subset (int): subset number for slots that are kept
             maxslot (int, default=999): max slots to keep in a config
             maxconfig (int, default=999): max configs to keep in a visit
+
+        Returns:
+            iterator of tuple: row for `sequence_numbers` table for each slot
         '''
-        sequence_numbers = []
-        prev_visit_id = None
-        prev_config_id = None
-        pure_visit = 0
-        pure_config = 0
-        pure_slot = 0
-        for visit_id, config_id, slot_id in rows:
-            if visit_id != prev_visit_id:
-                pure_visit += 1
-                pure_config = 1
-                pure_slot = 1
-            elif config_id != prev_config_id:
-                pure_config += 1
-                pure_slot = 1
-            else:
-                pure_slot += 1
-            if pure_config > maxconfig or pure_slot > maxslot:
-                sequence_numbers.append(
-                    (visit_id, config_id, slot_id, 0, 0, 0, 0)
-                )
-            else:
-                sequence_numbers.append(
-                    (visit_id, config_id, slot_id,
-                    self.pure_subset, pure_visit, pure_config, pure_slot)
-                )
-            prev_visit_id = visit_id
-            prev_config_id = config_id
-        return sequence_numbers
+        if not rows:
+            return iter([])
+        visit_id, config_id, slot_id = zip(*rows)
+        pure_visit, pure_config, pure_slot = count_sequences(
+            array(visit_id), array(config_id), maxslot, maxconfig
+        )
+        pure_subset = where(pure_visit > 0, pure_subset, 0)
+        return zip(
+            visit_id, config_id, slot_id, pure_subset.tolist(),
+            pure_visit.tolist(), pure_config.tolist(), pure_slot.tolist()
+        )
+
+
+def read_slot_data(slot_data_path=DEFAULT_SLOT_DATA_PATH):
+    '''Read slot data from a file.
+
+    Files with a .csv suffix are read as CSV without guessing the format,
+    which takes half as long. Other files are read as any ASCII table.
+
+    Args:
+        slot_data_path (str): path to file that contains slot data
+    '''
+    if str(slot_data_path).lower().endswith('.csv'):
+        slotdata = ascii_read(slot_data_path, format='csv', guess=False)
+    else:
+        slotdata = ascii_read(slot_data_path)
+    return slotdata
+
+
+def run_scenarios(
+        scenarios, slot_data_path=DEFAULT_SLOT_DATA_PATH, max_workers=None):
+    '''Assess independent scenarios in parallel worker processes.
+
+    Reads slot data once and sends it to each worker process once. Each
+    scenario gets its own `Scenario` database in a worker process.
+
+    Args:
+        scenarios (list of list of dict): for each scenario, keyword
+            arguments for each call to `Scenario.allocate_slots`
+        slot_data_path (str): path to file that contains slot data
+        max_workers (int, default=None): max number of worker processes
+
+    Returns:
+        list of astropy.table.Table: `Scenario.summarize` for each scenario
+    '''
+    slotdata = read_slot_data(slot_data_path)
+    with ProcessPoolExecutor(
+            max_workers, initializer=_init_worker,
+            initargs=(slot_data_path, slotdata)) as executor:
+        return list(executor.map(_run_scenario, scenarios))
+
+
+# Slot data path and slot data shared by scenarios in a worker process.
+_worker_slotdata = None
+
+
+def _init_worker(slot_data_path, slotdata):
+    '''Store slot data for use by every scenario in this worker process.'''
+    global _worker_slotdata
+    _worker_slotdata = (slot_data_path, slotdata)
+
+
+def _run_scenario(allocations):
+    '''Allocate slots for one scenario. Return summary table.'''
+    slot_data_path, slotdata = _worker_slotdata
+    scenario = Scenario(slot_data_path, slotdata=slotdata)
+    for kwargs in allocations:
+        scenario.allocate_slots(**kwargs)
+    return scenario.summarize(verbose=False)
+
+
+def count_sequences(visit_id, config_id, maxslot=999, maxconfig=999):
+    '''Return visit, config, and slot sequence numbers for ordered slots.
+
+    Sequence numbers are 0 for slots beyond `maxslot` slots in a config or
+    `maxconfig` configs in a visit.
+
+    Args:
+        visit_id (numpy.ndarray): visit identifier for each slot
+        config_id (numpy.ndarray): config identifier for each slot
+        maxslot (int, default=999): max slots to keep in a config
+        maxconfig (int, default=999): max configs to keep in a visit
+
+    Returns:
+        pure_visit (numpy.ndarray): visit sequence number for each slot
+        pure_config (numpy.ndarray): config sequence number within visit
+        pure_slot (numpy.ndarray): slot sequence number within config
+    '''
+    # Flag slots that start a new visit or a new config.
+    new_visit = ones(len(visit_id), dtype=bool)
+    new_visit[1:] = visit_id[1:] != visit_id[:-1]
+    new_config = new_visit.copy()
+    new_config[1:] |= config_id[1:] != config_id[:-1]
+
+    # Count visits. Count configs and slots since the most recent reset.
+    index = arange(len(visit_id))
+    nconfig = cumsum(new_config)
+    pure_visit = cumsum(new_visit)
+    pure_config = (
+        nconfig - maximum.accumulate(where(new_visit, nconfig, 0)) + 1
+    )
+    pure_slot = index - maximum.accumulate(where(new_config, index, 0)) + 1
+
+    # Zero sequence numbers for slots beyond maxslot or maxconfig.
+    keep = (pure_config <= maxconfig) & (pure_slot <= maxslot)
+    return (
+        where(keep, pure_visit, 0),
+        where(keep, pure_config, 0),
+        where(keep, pure_slot, 0),
+    )
+
+
+def table_from_rows(rows, colnames):
+    '''Return an astropy table built column by column from database rows.
+
+    Converting each column with numpy is much faster than Table(rows=rows),
+    which inspects every value. Columns that contain NULL have dtype object.
+
+    Args:
+        rows (list of tuple): rows returned by a database query
+        colnames (list of str): name of each column in a row
+    '''
+    columns = zip(*rows) if rows else [[]] * len(colnames)
+    return Table([array(column) for column in columns], names=colnames)
+
+
+def table_rows(table, chunksize=10000):
+    '''Yield rows of an astropy table as tuples, one chunk at a time.
+
+    Converts each column of a chunk to a list, then zips the columns into
+    rows, so only `chunksize` rows exist as Python objects at any time.
+    Masked values become None.
+
+    Args:
+        table (astropy.table.Table): table to iterate over
+        chunksize (int, default=10000): number of rows to convert at once
+    '''
+    columns = table.columns.values()
+    for start in range(0, len(table), chunksize):
+        stop = start + chunksize
+        yield from zip(*[column[start:stop].tolist() for column in columns])
 
 
 def sqltype(dtype):
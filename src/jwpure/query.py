@@ -2,50 +2,98 @@
 
 
 def where_clause(constraint, only_table=None):
-    '''Return a full WHERE clause (or empty string) for the filtered table.'''
-    sql = sql_from_constraint(constraint, only_table=only_table)
-    return f'WHERE {sql}' if sql else ''
+    '''Return a full WHERE clause (or empty string) for the filtered table.
+
+    Returns:
+        sql (str): WHERE clause with a `?` placeholder for each value
+        params (tuple): values to bind to the placeholders in `sql`
+    '''
+    sql, params = compile_constraint(constraint, only_table=only_table)
+    return (f'WHERE {sql}' if sql else ''), params
 
 
 def sql_from_constraint(constraint, only_table=None):
     '''Generate SQL for an parsed expression that constrains database columns.
 
+    Values appear in the SQL as literals.
+
     Args:
         constraint (_LogicalPredicate | _UnaryPredicate | _BinaryPredicate |
                     _TernaryPredicate): hierarchical tree of predicates
         only_table (str): optional, include only predicates for specified table
     '''
+    sql, params = compile_constraint(constraint, only_table=only_table)
+    return render_sql(sql, params)
+
+
+def render_sql(sql, params):
+    '''Return compiled SQL with each placeholder replaced by a literal value.
+
+    Args:
+        sql (str): SQL with a `?` placeholder for each value
+        params (tuple): values that correspond to the placeholders in `sql`
+    '''
+    # Placeholders are the only question marks in compiled SQL.
+    pieces = sql.split('?')
+    literals = [repr(value) for value in params] + ['']
+    return ''.join(piece + literal for piece, literal in zip(pieces, literals))
+
+
+def compile_constraint(constraint, only_table=None):
+    '''Compile a constraint into SQL with placeholders and parameter values.
+
+    The constraint is compiled on every call, so parameters always reflect
+    the current values in the predicates (e.g. a modified `isin` list).
+
+    Args:
+        constraint (_LogicalPredicate | _UnaryPredicate | _BinaryPredicate |
+                    _TernaryPredicate): hierarchical tree of predicates
+        only_table (str): optional, include only predicates for specified table
+
+    Returns:
+        sql (str): SQL with a `?` placeholder for each value
+        params (tuple): values that correspond to the placeholders in `sql`
+    '''
     if constraint is None:
-        return ''
+        return '', ()
+    if not isinstance(constraint, _Expression):
+        raise TypeError(f'Unknown constraint type: {type(constraint)}')
+    return _compile(constraint, only_table)
+
+
+def _compile(constraint, only_table=None):
+    '''Compile one predicate. See `compile_constraint`.'''
     if isinstance(constraint, _BinaryPredicate):
         if only_table and not constraint.colname.startswith(f'{only_table}.'):
-            return ''
+            return '', ()
         if constraint.operator == 'IN':
-            vstr = '(' + ', '.join(repr(v) for v in constraint.value) + ')'
+            params = tuple(constraint.value)
+            placeholders = '(' + ', '.join(['?'] * len(params)) + ')'
         else:
-            vstr = repr(constraint.value)
-        return f'{constraint.colname} {constraint.operator} {vstr}'
+            params = (constraint.value,)
+            placeholders = '?'
+        sql = f'{constraint.colname} {constraint.operator} {placeholders}'
+        return sql, params
     elif isinstance(constraint, _TernaryPredicate):
         if only_table and not constraint.colname.startswith(f'{only_table}.'):
-            return ''
+            return '', ()
         return (
-            f'{constraint.colname} BETWEEN '
-            f'{repr(constraint.low)} AND '
-            f'{repr(constraint.high)}'
+            f'{constraint.colname} BETWEEN ? AND ?',
+            (constraint.low, constraint.high)
         )
     elif isinstance(constraint, _UnaryPredicate):
         if only_table and not constraint.raw_sql.startswith(f'{only_table}.'):
-            return ''
-        return constraint.raw_sql
+            return '', ()
+        return constraint.raw_sql, ()
     elif isinstance(constraint, _LogicalPredicate):
         if constraint.op == 'NOT':
-            sql = sql_from_constraint(constraint.args[0], only_table)
-            return f'(NOT {sql})' if sql else ''
-        left = sql_from_constraint(constraint.args[0], only_table)
-        right = sql_from_constraint(constraint.args[1], only_table)
+            sql, params = compile_constraint(constraint.args[0], only_table)
+            return (f'(NOT {sql})', params) if sql else ('', ())
+        left, lparams = compile_constraint(constraint.args[0], only_table)
+        right, rparams = compile_constraint(constraint.args[1], only_table)
         if left and right:
-            return f'({left} {constraint.op} {right})'
-        return left or right
+            return f'({left} {constraint.op} {right})', lparams + rparams
+        return (left, lparams) if left else (right, rparams)
     else:
         raise TypeError(f'Unknown constraint type: {type(constraint)}')
 
@@ -1,4 +1,5 @@
-from jwpure.analyze import Scenario
+from jwpure.analyze import Scenario, count_sequences, run_scenarios
+from numpy import array
 import pytest
 import filecmp
 from importlib import resources
@@ -30,3 +31,88 @@ def test_jwpure(test_file, tmp_path_factory):
     scenario.save(filename)
     are_equal = filecmp.cmp(filename, test_file, shallow=True)
     assert are_equal, f"Files {filename} and {test_file} are not equal"
+
+
+def test_count_sequences():
+    """Verify sequence numbers reset per visit and config and obey limits"""
+    visit_id = array(['1', '1', '1', '1', '2', '2', '2'])
+    config_id = array(['a', 'a', 'a', 'b', 'c', 'd', 'e'])
+    pure_visit, pure_config, pure_slot = count_sequences(
+        visit_id, config_id, maxslot=2, maxconfig=2
+    )
+    assert pure_visit.tolist() == [1, 1, 0, 1, 2, 2, 0]
+    assert pure_config.tolist() == [1, 1, 0, 2, 1, 2, 0]
+    assert pure_slot.tolist() == [1, 2, 0, 1, 1, 1, 0]
+
+
+def test_run_scenarios():
+    """Verify scenarios run in worker processes match scenarios run serially"""
+    slot, config, visit = Scenario.constraint_parameters()
+    scenarios = [
+        [{'constraint': (slot.inst == 'NIRSpec') & (config.nslot >= 3)}],
+        [{'constraint': slot.slotdur.between(300, 900), 'maxslot': 2}],
+    ]
+    summaries = run_scenarios(scenarios, max_workers=2)
+    for allocations, summary in zip(scenarios, summaries):
+        scenario = Scenario()
+        for kwargs in allocations:
+            scenario.allocate_slots(**kwargs)
+        expected = scenario.summarize(verbose=False)
+        assert summary.pformat() == expected.pformat()
+
+
+def test_reload_saved_slots(test_file):
+    """Verify slot data that already has pure_* columns loads unallocated"""
+    scenario = Scenario(test_file)
+    summary = scenario.summarize(verbose=False)
+    assert set(summary['pure_subset']) == {0}
+    assert sum(summary['nslot']) == len(scenario.raw_query(
+        'SELECT slot_id FROM slot WHERE pure_visit = 0 AND pure_slot = 0'
+    ))
+
+
+def test_failed_pass_rolls_back():
+    """Verify a pass that fails after updating slots leaves no trace"""
+    slot, config, visit = Scenario.constraint_parameters()
+    scenario = Scenario()
+    scenario.allocate_slots(slot.inst == 'NIRSpec', maxslot=3)
+    expected = scenario.summarize(verbose=False).pformat()
+
+    class FailAfterUpdate:
+        def __init__(self, cursor):
+            self.cursor = cursor
+
+        def execute(self, sql, *args):
+            result = self.cursor.execute(sql, *args)
+            if sql.lstrip().startswith('UPDATE slot'):
+                raise RuntimeError('fail after UPDATE slot')
+            return result
+
+        def __getattr__(self, name):
+            return getattr(self.cursor, name)
+
+    cursor = scenario.cursor
+    scenario.cursor = FailAfterUpdate(cursor)
+    with pytest.raises(RuntimeError):
+        scenario.allocate_slots(slot.slotdur > 0)
+    scenario.cursor = cursor
+    assert scenario.summarize(verbose=False).pformat() == expected
+    assert scenario.pure_subset == 1
+    assert len(scenario.where_joint) == 1
+
+
+def test_reuse_mutated_constraint():
+    """Verify a reused constraint picks up changes to its isin list"""
+    slot, config, visit = Scenario.constraint_parameters()
+    insts = ['NIRSpec']
+    constraint = slot.inst.isin(insts)
+    scenario = Scenario()
+    scenario.allocate_slots(constraint)
+    insts.append('MIRI')
+    scenario.allocate_slots(constraint)
+    miri = scenario.raw_query('''
+        SELECT DISTINCT pure_subset FROM slot
+        WHERE inst = 'MIRI' AND pure_subset > 0
+    ''')
+    assert miri is not None
+    assert list(miri['pure_subset']) == [2]